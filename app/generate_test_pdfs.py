@@ -4,8 +4,15 @@ Generate sample PDFs for testing the form filler application.
 Run this script to create questions.pdf and data.pdf
 """
 
-from fpdf import FPDF
-import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from fpdf import FPDF
+except ImportError:
+    print("ERROR: fpdf2 is not installed!")
+    print("Please run: pip install fpdf2")
+    sys.exit(1)
 
 def generate_questions_pdf(filename='questions.pdf'):
     """Generate a PDF with sample questions"""
@@ -123,21 +130,17 @@ def main():
     print("=" * 60)
     print()
     
-    # Check if fpdf2 is installed
-    try:
-        from fpdf import FPDF
-    except ImportError:
-        print("ERROR: fpdf2 is not installed!")
-        print("Please run: pip install fpdf2")
-        return
-    
     # Generate PDFs
     print("Generating PDFs...")
     print()
-    
-    generate_questions_pdf()
-    generate_data_pdf()
-    
+
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        futures = [ex.submit(generate_questions_pdf), ex.submit(generate_data_pdf)]
+
+    # Surface any generation error instead of claiming success below
+    for future in futures:
+        future.result()
+
     print()
     print("=" * 60)
     print("✓ Success! PDFs created in current directory")
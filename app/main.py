@@ -1,129 +1,373 @@
-from fastapi import FastAPI, File, UploadFile
-from fastapi.responses import FileResponse, HTMLResponse
-import requests
-import tempfile
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, File, Request, UploadFile
+from fastapi.responses import HTMLResponse, ORJSONResponse, StreamingResponse
+import asyncio
+import hashlib
+import httpx
+from async_lru import alru_cache
 import io
-import pdfplumber
+import orjson
+import textwrap
+import fitz
+from concurrent.futures import ThreadPoolExecutor
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import letter
 import os
-import time
-
-app = FastAPI()
+from functools import lru_cache
+import numpy as np
+import torch
+from optimum.onnxruntime import ORTModelForQuestionAnswering, ORTQuantizer
+from optimum.onnxruntime.configuration import AutoQuantizationConfig
+from sentence_transformers import SentenceTransformer
+from transformers import AutoTokenizer
 
 # Hugging Face API settings
 HF_API_URL = "https://api-inference.huggingface.co/models/deepset/roberta-base-squad2"
 HF_TOKEN = os.getenv("HF_TOKEN")  # Set this as environment variable
 
-def query_huggingface(question: str, context: str, max_retries=3):
+# Backend selection: "hf-api" (default) calls the hosted Inference API,
+# "local" runs the model in-process.
+QA_BACKEND = os.getenv("QA_BACKEND", "hf-api")
+# Distilled model: ~4x smaller than roberta-base-squad2 at equivalent F1
+QA_MODEL = os.getenv("QA_MODEL", "deepset/tinyroberta-squad2")
+# Where the exported, INT8-quantized copy of QA_MODEL is cached on disk
+QA_INT8_DIR = os.getenv("QA_INT8_DIR", "qa-int8")
+
+# Retrieval settings for the HF API path: embed context chunks once,
+# then send each question only its top-k chunks instead of the whole context
+EMBED_MODEL = os.getenv("EMBED_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+CHUNK_SIZE = 400
+CHUNK_OVERLAP = 50
+TOP_K_CHUNKS = 3
+
+def _load_quantized_model():
+    """Export and INT8-quantize the QA model once, then reuse the on-disk copy"""
+    if not os.path.isdir(QA_INT8_DIR):
+        model = ORTModelForQuestionAnswering.from_pretrained(QA_MODEL, export=True)
+        quantizer = ORTQuantizer.from_pretrained(model)
+        qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=True)
+        quantizer.quantize(save_dir=QA_INT8_DIR, quantization_config=qconfig)
+        AutoTokenizer.from_pretrained(QA_MODEL).save_pretrained(QA_INT8_DIR)
+    return ORTModelForQuestionAnswering.from_pretrained(QA_INT8_DIR)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.qa_model = None
+    app.state.qa_tokenizer = None
+    app.state.encoder = None
+    if QA_BACKEND == "local":
+        app.state.qa_model = _load_quantized_model()
+        app.state.qa_tokenizer = AutoTokenizer.from_pretrained(QA_INT8_DIR)
+    else:
+        app.state.encoder = SentenceTransformer(EMBED_MODEL)
+    yield
+    await _hf_client.aclose()
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
+# How many questions may be inflight against the HF API at once
+MAX_CONCURRENCY = 8
+
+# Shared pool for blocking PDF parse/render work so it never runs on the event loop
+_PDF_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="pdf")
+
+# Keep-alive client so TLS handshakes and connections are amortized across
+# all HF API calls instead of paid once per question
+_hf_client = httpx.AsyncClient(
+    http2=True,
+    timeout=30,
+    headers={"Authorization": f"Bearer {HF_TOKEN}"} if HF_TOKEN else {},
+)
+
+def _context_key(context):
+    """Short stable digest so cache keys don't hold full context strings"""
+    return hashlib.blake2b(context.encode(), digest_size=16).digest()
+
+@alru_cache(maxsize=4096)
+async def _cached_hf_answer(question, ctx_key, context):
+    answer = await query_huggingface(question, context)
+    if not answer:
+        # An empty answer means a timeout, 5xx or exhausted retries, not a
+        # real result - drop the entry so the next request retries the API
+        _cached_hf_answer.cache_invalidate(question, ctx_key, context)
+    return answer
+
+def _split_context(context, chunk_size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
+    """Split context into overlapping character chunks"""
+    chunks = []
+    step = chunk_size - overlap
+    for start in range(0, len(context), step):
+        chunk = context[start:start + chunk_size].strip()
+        if chunk:
+            chunks.append(chunk)
+        if start + chunk_size >= len(context):
+            break
+    return chunks
+
+def _retrieve_contexts(questions, context, encoder):
+    """Embed the context chunks once and pick the top-k chunks per question"""
+    chunks = _split_context(context)
+    if len(chunks) <= TOP_K_CHUNKS:
+        return {q: context for q in questions}
+
+    ctx_vecs = encoder.encode(chunks, normalize_embeddings=True, batch_size=32)
+    q_vecs = encoder.encode(questions, normalize_embeddings=True, batch_size=32)
+
+    retrieved = {}
+    for q, q_vec in zip(questions, q_vecs):
+        scores = ctx_vecs @ q_vec
+        top = np.argpartition(-scores, TOP_K_CHUNKS)[:TOP_K_CHUNKS]
+        retrieved[q] = "\n".join(chunks[i] for i in sorted(top))
+    return retrieved
+
+async def query_huggingface(question: str, context: str, max_retries=3):
     """Query Hugging Face Inference API with retries"""
-    headers = {"Authorization": f"Bearer {HF_TOKEN}"} if HF_TOKEN else {}
-    
     payload = {
         "inputs": {
             "question": question,
             "context": context
         }
     }
-    
+
     for attempt in range(max_retries):
         try:
-            response = requests.post(HF_API_URL, headers=headers, json=payload, timeout=30)
-            
+            response = await _hf_client.post(HF_API_URL, json=payload)
+
             if response.status_code == 503:
                 # Model is loading, wait and retry
                 print(f"Model loading, waiting 20 seconds... (attempt {attempt + 1})")
-                time.sleep(20)
+                await asyncio.sleep(20)
                 continue
             elif response.status_code == 429:
-                # Rate limited, wait and retry
-                print(f"Rate limited, waiting 10 seconds... (attempt {attempt + 1})")
-                time.sleep(10)
+                # Rate limited: honor Retry-After when the server sends it,
+                # otherwise back off exponentially from 1s
+                retry_after = response.headers.get("Retry-After")
+                try:
+                    wait = float(retry_after)
+                except (TypeError, ValueError):
+                    wait = 2 ** attempt
+                print(f"Rate limited, waiting {wait:g} seconds... (attempt {attempt + 1})")
+                await asyncio.sleep(wait)
                 continue
             elif response.status_code == 200:
-                result = response.json()
+                result = orjson.loads(response.content)
                 return result.get("answer", "")
             else:
                 print(f"API error: {response.status_code} - {response.text}")
                 return ""
-                
-        except requests.exceptions.Timeout:
+
+        except httpx.TimeoutException:
             print(f"Request timeout (attempt {attempt + 1})")
             if attempt < max_retries - 1:
-                time.sleep(5)
+                await asyncio.sleep(5)
                 continue
         except Exception as e:
             print(f"Error querying Hugging Face API: {e}")
             return ""
-    
+
     return ""
 
+def _page_text(args):
+    # Each worker opens its own Document: PyMuPDF is not thread-safe, so
+    # pages of one shared Document must never be touched from multiple threads
+    pdf_bytes, i = args
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as pdf:
+        return pdf[i].get_text()
+
 def extract_text_from_pdf_bytes(pdf_bytes: bytes):
-    with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
-        text = "\n".join([page.extract_text() or "" for page in pdf.pages])
-    return text
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as pdf:
+        page_count = pdf.page_count
+        # Not worth spinning up threads for a page or two
+        if page_count <= 2:
+            return "\n".join(page.get_text() for page in pdf)
+
+    with ThreadPoolExecutor(max_workers=min(8, page_count)) as ex:
+        texts = list(ex.map(_page_text, ((pdf_bytes, i) for i in range(page_count))))
+    return "\n".join(texts)
 
 def extract_questions(pdf_bytes: bytes):
-    text = extract_text_from_pdf_bytes(pdf_bytes)
-    lines = text.splitlines()
-    questions = [line.strip() for line in lines if "?" in line and len(line.strip()) > 5]
+    # Scan page by page instead of joining the whole document into one
+    # string just to split it back into lines
+    questions = []
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as pdf:
+        for page in pdf:
+            for raw in page.get_text().splitlines():
+                # Cheap length and membership checks first; only strip
+                # (which allocates) lines that can still qualify
+                if len(raw) <= 5:
+                    continue
+                if "?" not in raw:
+                    continue
+                s = raw.strip()
+                if len(s) > 5:
+                    questions.append(s)
     return questions
 
-def answer_questions(questions, context):
-    """Answer questions using Hugging Face Inference API"""
-    qa_pairs = []
-    
-    # Truncate context if too long (HF API has limits)
-    if len(context) > 4000:
-        context = context[:4000] + "..."
-    
-    for i, q in enumerate(questions):
-        print(f"Processing question {i+1}/{len(questions)}: {q[:50]}...")
-        
-        # Clean up question
-        q = q.strip()
-        if not q:
-            continue
-            
-        answer = query_huggingface(q, context)
-        qa_pairs.append((q, answer if answer else "Unable to find answer"))
-        
-        # Add small delay to avoid rate limiting
-        time.sleep(1)
-    
-    return qa_pairs
+# LRU of (question, context digest) -> answer for the local backend.
+# A plain dict (insertion-ordered) instead of functools.lru_cache so cache
+# misses can still go through the model in one batched call.
+_QA_CACHE = {}
+_QA_CACHE_MAX = 4096
+
+# Local backend inference settings (mirror the pipeline defaults we replaced)
+QA_MAX_LENGTH = 384
+QA_DOC_STRIDE = 128
+QA_BATCH_SIZE = 8
+# Room reserved in each window for the question and special tokens
+QA_QUESTION_BUDGET = 64
+QA_MAX_ANSWER_TOKENS = 30
+
+@lru_cache(maxsize=8)
+def _encode_context(context, tokenizer):
+    """Tokenize the context once into overlapping windows shared by every question"""
+    enc = tokenizer(context, add_special_tokens=False, return_offsets_mapping=True)
+    ids = enc["input_ids"]
+    offsets = enc["offset_mapping"]
+
+    window = QA_MAX_LENGTH - QA_QUESTION_BUDGET
+    step = window - QA_DOC_STRIDE
+    windows = []
+    for start in range(0, len(ids), step):
+        windows.append((ids[start:start + window], offsets[start:start + window]))
+        if start + window >= len(ids):
+            break
+    return windows
+
+def _answer_batch(questions, context, tokenizer, model):
+    """Answer a batch of questions against cached context windows.
+
+    Only the questions are tokenized here; the context token ids and offsets
+    come from _encode_context, so the sliding-window pass over the context
+    happens once per context rather than once per question. Every
+    (question, window) pair then goes through padded forward passes of
+    QA_BATCH_SIZE rows each.
+    """
+    windows = _encode_context(context, tokenizer)
+    cls_id = tokenizer.cls_token_id
+    sep_id = tokenizer.sep_token_id
+    pad_id = tokenizer.pad_token_id
+
+    # rows: (question index, window index, context prefix length, token ids)
+    rows = []
+    for qi, q in enumerate(questions):
+        # Stay within the question budget (and the model's position limit):
+        # the 4 special tokens around question and context come out of it too
+        q_ids = tokenizer(q, add_special_tokens=False)["input_ids"][:QA_QUESTION_BUDGET - 4]
+        prefix = len(q_ids) + 3  # <s> question </s></s>
+        for wi, (ctx_ids, _) in enumerate(windows):
+            rows.append((qi, wi, prefix, [cls_id] + q_ids + [sep_id, sep_id] + ctx_ids + [sep_id]))
+
+    best = {}  # question index -> (score, answer)
+    for batch_start in range(0, len(rows), QA_BATCH_SIZE):
+        batch = rows[batch_start:batch_start + QA_BATCH_SIZE]
+        max_len = max(len(ids) for _, _, _, ids in batch)
+        input_ids = torch.full((len(batch), max_len), pad_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(batch), max_len), dtype=torch.long)
+        for r, (_, _, _, ids) in enumerate(batch):
+            input_ids[r, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[r, :len(ids)] = 1
+
+        out = model(input_ids=input_ids, attention_mask=attention_mask)
 
-def generate_filled_pdf(qa_pairs, output_path):
-    c = canvas.Canvas(output_path, pagesize=letter)
+        for r, (qi, wi, prefix, _) in enumerate(batch):
+            ctx_ids, offsets = windows[wi]
+            s_logits = out.start_logits[r][prefix:prefix + len(ctx_ids)]
+            e_logits = out.end_logits[r][prefix:prefix + len(ctx_ids)]
+            null_score = (out.start_logits[r][0] + out.end_logits[r][0]).item()
+
+            s = int(torch.argmax(s_logits))
+            e = s + int(torch.argmax(e_logits[s:s + QA_MAX_ANSWER_TOKENS]))
+            score = (s_logits[s] + e_logits[e]).item() - null_score
+            # Negative score means the no-answer span beats the best span
+            answer = context[offsets[s][0]:offsets[e][1]].strip() if score > 0 else ""
+
+            if qi not in best or score > best[qi][0]:
+                best[qi] = (score, answer)
+
+    return [best[qi][1] for qi in range(len(questions))]
+
+def answer_questions_local(questions, context, tokenizer, model):
+    """Answer questions with the in-process model in batched forward passes"""
+    questions = [q.strip() for q in questions if q.strip()]
+    if not questions:
+        return []
+
+    ctx_key = _context_key(context)
+    unique = list(dict.fromkeys(questions))
+    misses = [q for q in unique if (q, ctx_key) not in _QA_CACHE]
+
+    if misses:
+        try:
+            answers = _answer_batch(misses, context, tokenizer, model)
+        except Exception as e:
+            print(f"Error running local QA model: {e}")
+            return [(q, "Unable to find answer") for q in questions]
+
+        for q, answer in zip(misses, answers):
+            while len(_QA_CACHE) >= _QA_CACHE_MAX:
+                _QA_CACHE.pop(next(iter(_QA_CACHE)))
+            _QA_CACHE[(q, ctx_key)] = answer
+
+    return [(q, _QA_CACHE[(q, ctx_key)] or "Unable to find answer") for q in questions]
+
+async def answer_questions(questions, context, encoder):
+    """Answer questions concurrently using Hugging Face Inference API"""
+    questions = [q.strip() for q in questions if q.strip()]
+    if not questions:
+        return []
+
+    # Query each distinct question once, then project back onto the original list
+    unique = list(dict.fromkeys(questions))
+
+    # Each question gets only its most relevant chunks instead of the full
+    # context, so the QA model stops re-encoding identical long input N times
+    loop = asyncio.get_running_loop()
+    contexts = await loop.run_in_executor(
+        _PDF_EXECUTOR, _retrieve_contexts, unique, context, encoder
+    )
+
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+
+    async def one(q):
+        async with sem:
+            ctx = contexts[q]
+            return q, await _cached_hf_answer(q, _context_key(ctx), ctx)
+
+    answers = dict(await asyncio.gather(*(one(q) for q in unique)))
+
+    return [(q, answers[q] if answers[q] else "Unable to find answer") for q in questions]
+
+def generate_filled_pdf(qa_pairs, output):
+    """Render the Q&A pairs as a PDF into output (a path or file-like object)"""
+    c = canvas.Canvas(output, pagesize=letter)
     width, height = letter
     y = height - 50
-    
+
     for q, a in qa_pairs:
-        # Handle long text by wrapping
-        q_lines = [q[i:i+80] for i in range(0, len(q), 80)]
-        a_lines = [a[i:i+80] for i in range(0, len(a), 80)]
-        
-        # Draw question
-        c.drawString(30, y, f"Q: {q_lines[0]}")
-        y -= 15
-        for line in q_lines[1:]:
-            c.drawString(50, y, line)
-            y -= 15
-        
-        # Draw answer
-        c.drawString(30, y, f"A: {a_lines[0]}")
-        y -= 15
-        for line in a_lines[1:]:
-            c.drawString(50, y, line)
-            y -= 15
-        
-        y -= 20  # Extra space between Q&A pairs
-        
-        # New page if needed
-        if y < 100:
+        # Wrap on word boundaries instead of hard 80-char slices
+        q_lines = textwrap.wrap(q, 80) or [""]
+        a_lines = textwrap.wrap(a, 80) or [""]
+
+        # New page if the whole Q&A block won't fit
+        block_height = 15 * (len(q_lines) + len(a_lines))
+        if y - block_height < 100:
             c.showPage()
             y = height - 50
-    
+
+        # One text object per block writes a single BT...ET segment
+        # instead of re-issuing font state per drawString call
+        tobj = c.beginText(30, y)
+        tobj.setFont("Helvetica", 10)
+        tobj.textLines("\n".join(
+            [f"Q: {q_lines[0]}"]
+            + [f"   {line}" for line in q_lines[1:]]
+            + [f"A: {a_lines[0]}"]
+            + [f"   {line}" for line in a_lines[1:]]
+        ))
+        c.drawText(tobj)
+
+        y -= block_height + 20  # Extra space between Q&A pairs
+
     c.save()
 
 @app.get("/", response_class=HTMLResponse)
@@ -171,16 +415,20 @@ def upload_form():
     return html
 
 @app.post("/fill-form")
-async def fill_form(questions_pdf: UploadFile = File(...), data_pdf: UploadFile = File(...)):
+async def fill_form(request: Request, questions_pdf: UploadFile = File(...), data_pdf: UploadFile = File(...)):
     try:
         print("Reading uploaded files...")
         questions_bytes = await questions_pdf.read()
         data_bytes = await data_pdf.read()
         
-        print("Extracting questions...")
-        questions = extract_questions(questions_bytes)
+        print("Extracting questions and context...")
+        loop = asyncio.get_running_loop()
+        questions, context = await asyncio.gather(
+            loop.run_in_executor(_PDF_EXECUTOR, extract_questions, questions_bytes),
+            loop.run_in_executor(_PDF_EXECUTOR, extract_text_from_pdf_bytes, data_bytes),
+        )
         print(f"Found {len(questions)} questions")
-        
+
         if not questions:
             return HTMLResponse(
                 "<h3>Error: No questions found in the PDF. Make sure questions end with '?'</h3>"
@@ -188,9 +436,6 @@ async def fill_form(questions_pdf: UploadFile = File(...), data_pdf: UploadFile
                 status_code=400
             )
         
-        print("Extracting context...")
-        context = extract_text_from_pdf_bytes(data_bytes)
-        
         if len(context) < 50:
             return HTMLResponse(
                 "<h3>Error: Not enough context found in the data PDF.</h3>"
@@ -199,17 +444,22 @@ async def fill_form(questions_pdf: UploadFile = File(...), data_pdf: UploadFile
             )
         
         print("Processing with AI...")
-        qa_pairs = answer_questions(questions, context)
+        if QA_BACKEND == "local":
+            qa_pairs = await loop.run_in_executor(
+                _PDF_EXECUTOR, answer_questions_local,
+                questions, context,
+                request.app.state.qa_tokenizer, request.app.state.qa_model,
+            )
+        else:
+            qa_pairs = await answer_questions(questions, context, request.app.state.encoder)
 
         print("Generating PDF...")
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
-            output_path = tmp.name
-        
-        generate_filled_pdf(qa_pairs, output_path)
-        
-        return FileResponse(
-            output_path, 
-            filename="filled_form.pdf", 
+        buf = io.BytesIO()
+        await loop.run_in_executor(_PDF_EXECUTOR, generate_filled_pdf, qa_pairs, buf)
+        buf.seek(0)
+
+        return StreamingResponse(
+            buf,
             media_type="application/pdf",
             headers={"Content-Disposition": "attachment; filename=filled_form.pdf"}
         )